@@ -5,6 +5,28 @@ class Settings(BaseSettings):
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
 
+    # Sharding: user data is spread over SHARD_COUNT SQLite files in SHARD_DIR,
+    # the email -> shard directory lives next to them.
+    SHARD_COUNT: int = 4
+    SHARD_DIR: str = "./shards"
+    # Seconds app.rebalance waits after blocking a user for in-flight requests to finish
+    SHARD_MOVE_DRAIN_SECONDS: float = 2.0
+
+    # Background task runner (app/tasks.py)
+    TASK_WORKERS: int = 2
+    TASK_POLL_INTERVAL_SECONDS: float = 1.0
+    TASK_MAX_ATTEMPTS: int = 5
+    TASK_LOCK_TIMEOUT_SECONDS: int = 300
+    TASK_RETENTION_HOURS: int = 24
+
+    # Leaderboards (app/leaderboard.py)
+    LEADERBOARD_SNAPSHOT_INTERVAL_SECONDS: int = 300
+
+    # Focus session heartbeats (app/heartbeats.py)
+    HEARTBEAT_FLUSH_INTERVAL_SECONDS: float = 10.0
+    HEARTBEAT_MAX_PENDING: int = 5000
+    HEARTBEAT_TIMEOUT_SECONDS: int = 120
+
     class Config:
         env_file = ".env"
 
@@ -1,6 +1,12 @@
-from sqlalchemy.orm import Session
+from datetime import date, datetime, timedelta
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, joinedload
 from . import models, schemas
+from .core.config import settings
+from .core.plan_generator import generate_20_hour_plan
 from .core.security import get_password_hash
+from .database import shard_for_user
 
 def get_user(db: Session, user_id: int):
     return db.query(models.User).filter(models.User.id == user_id).first()
@@ -8,9 +14,38 @@ def get_user(db: Session, user_id: int):
 def get_user_by_email(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
 
-def create_user(db: Session, user: schemas.UserCreate):
-    hashed_password = get_password_hash(user.password)
-    db_user = models.User(email=user.email, username=user.username, hashed_password=hashed_password)
+def get_directory_entry(directory: Session, user_id: int):
+    return directory.query(models.UserDirectory).filter(models.UserDirectory.id == user_id).first()
+
+def get_directory_entry_by_email(directory: Session, email: str):
+    return directory.query(models.UserDirectory).filter(models.UserDirectory.email == email).first()
+
+def create_directory_entry(directory: Session, email: str):
+    # Flush (not commit) so the global id is allocated while the caller
+    # still holds the directory transaction open for the shard insert
+    entry = models.UserDirectory(email=email, shard=0)
+    directory.add(entry)
+    directory.flush()
+    entry.shard = shard_for_user(entry.id)
+    directory.flush()
+    return entry
+
+def get_shard_generation(directory: Session):
+    layout = directory.get(models.ShardLayout, 1)
+    return layout.generation if layout else 0
+
+def bump_shard_generation(directory: Session):
+    layout = directory.get(models.ShardLayout, 1)
+    if not layout:
+        layout = models.ShardLayout(id=1, generation=0)
+        directory.add(layout)
+    layout.generation += 1
+    directory.commit()
+    return layout.generation
+
+def create_user(db: Session, user: schemas.UserCreate, user_id: int = None, hashed_password: str = None):
+    hashed_password = hashed_password or get_password_hash(user.password)
+    db_user = models.User(id=user_id, email=user.email, username=user.username, hashed_password=hashed_password)
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
@@ -22,29 +57,135 @@ def get_active_skill(db: Session, user_id: int):
         models.Skill.status == "active"
     ).order_by(models.Skill.created_at.desc()).first()
 
+def enqueue_task(db: Session, name: str, payload: dict = None, key: str = None):
+    # Not committed here: the task is written in the caller's transaction,
+    # so it exists if and only if the triggering write does.
+    if key:
+        # The key only dedupes tasks that have not run yet: skill ids are
+        # reused after a shard move, so a finished task must not block a new one.
+        pending = any(isinstance(obj, models.OutboxTask) and obj.idempotency_key == key for obj in db.new)
+        existing = db.query(models.OutboxTask).filter(models.OutboxTask.idempotency_key == key).first()
+        if pending or (existing and existing.status in ("pending", "running")):
+            return None
+        if existing:
+            # Release the unique key held by the finished task
+            existing.idempotency_key = None
+            db.flush()
+    task = models.OutboxTask(name=name, payload=payload or {}, idempotency_key=key, max_attempts=settings.TASK_MAX_ATTEMPTS)
+    db.add(task)
+    return task
+
+def schedule_plan_generation(db: Session, skill_id: int):
+    # Day 1 is the day the skill was started, not the day the task happens to run
+    return enqueue_task(db, "generate_plan", {"skill_id": skill_id, "start_date": date.today().isoformat()}, key=f"generate_plan:{skill_id}")
+
 def create_skill(db: Session, skill: schemas.SkillCreate, user_id: int):
     db_skill = models.Skill(**skill.dict(), user_id=user_id)
     db.add(db_skill)
+    db.flush()
+    # Plan is generated in the background, only for active skills
+    if db_skill.status == "active":
+        schedule_plan_generation(db, db_skill.id)
     db.commit()
     db.refresh(db_skill)
     return db_skill
 
-def create_daily_plan(db: Session, plan_data: dict, skill_id: int):
-    db_plan = models.DailyPlan(**plan_data, skill_id=skill_id)
-    db.add(db_plan)
+def create_daily_plans(db: Session, skill: models.Skill, start_date: date):
+    # Single transaction for the whole plan, committed by the caller
+    for plan in generate_20_hour_plan(skill.name, skill.daily_minutes):
+        # Day 1 = start date, Day 2 = start date + 1
+        plan['scheduled_date'] = start_date + timedelta(days=plan['day_number'] - 1)
+        db.add(models.DailyPlan(**plan, skill_id=skill.id))
+    db.flush()
+
+def get_or_create_resource_url(db: Session, url: str):
+    url = url.strip()
+    # ON CONFLICT keeps concurrent inserts of the same URL from failing
+    db.execute(sqlite_insert(models.ResourceUrl).values(url=url, created_at=datetime.utcnow()).on_conflict_do_nothing(index_elements=["url"]))
+    return db.query(models.ResourceUrl).filter(models.ResourceUrl.url == url).one()
+
+def add_plan_resource(db: Session, plan_id: int, resource: schemas.PlanResourceCreate):
+    # Append-only: one new row per resource, the plan row itself is untouched
+    resource_url = get_or_create_resource_url(db, resource.url)
+    db_resource = models.PlanResource(plan_id=plan_id, resource_url_id=resource_url.id, title=resource.title, type=resource.type)
+    db.add(db_resource)
+    db.flush()
+    return db_resource
+
+def get_plan_resources(db: Session, plan_id: int):
+    return db.query(models.PlanResource).options(joinedload(models.PlanResource.resource_url)).filter(
+        models.PlanResource.plan_id == plan_id
+    ).order_by(models.PlanResource.id).all()
+
+def migrate_legacy_resources(db: Session):
+    # One-time move of DailyPlan.resources JSON into plan_resources; a migrated
+    # plan gets NULL so it is skipped on the next start. json_type() is NULL
+    # for SQL NULL and 'null' for the JSON null older builds wrote instead.
+    plans = db.query(models.DailyPlan).filter(func.json_type(models.DailyPlan.legacy_resources) != "null").all()
+    for plan in plans:
+        for item in plan.legacy_resources or []:
+            if isinstance(item, dict) and item.get("url"):
+                add_plan_resource(db, plan.id, schemas.PlanResourceCreate(
+                    title=item.get("title") or item["url"],
+                    url=item["url"],
+                    type=item.get("type") or "link",
+                ))
+        plan.legacy_resources = None
     db.commit()
-    db.refresh(db_plan)
-    return db_plan
-
-def create_session(db: Session, session: schemas.SessionCreate, skill_id: int):
+    return len(plans)
+
+def create_session(db: Session, session: schemas.SessionCreate, skill_id: int, user_id: int, client_session_id: str = None):
+    if client_session_id:
+        recorded = close_open_session(db, user_id, skill_id, client_session_id)
+        if recorded:
+            # Already finalized from its heartbeats (or a retried request):
+            # the same session must not be counted twice. A tab that slept past
+            # HEARTBEAT_TIMEOUT_SECONDS still knows the real duration.
+            if session.duration_minutes > recorded.duration_minutes:
+                recorded.duration_minutes = session.duration_minutes
+                enqueue_task(db, "award_badges", {"user_id": user_id})
+            db.commit()
+            db.refresh(recorded)
+            return recorded
     db_session = models.Session(**session.dict(), skill_id=skill_id)
     db.add(db_session)
+    db.flush()
+    if client_session_id:
+        db.query(models.OpenSession).filter(
+            models.OpenSession.client_session_id == client_session_id,
+            models.OpenSession.user_id == user_id,
+        ).update({models.OpenSession.status: "closed", models.OpenSession.session_id: db_session.id}, synchronize_session=False)
+    enqueue_task(db, "award_badges", {"user_id": user_id})
     db.commit()
     db.refresh(db_session)
     return db_session
 
+def close_open_session(db: Session, user_id: int, skill_id: int, client_session_id: str):
+    """Mark the heartbeat-tracked session closed and return its Session row if
+    one was already recorded for it."""
+    # Insert-or-close so a heartbeat flush arriving later cannot reopen it.
+    # Only "open" rows change. The upsert takes the shard's write lock, and
+    # finalize_stale claims rows with a conditional update, so whichever of
+    # the two runs second sees the other's result.
+    stmt = sqlite_insert(models.OpenSession).values(
+        client_session_id=client_session_id, user_id=user_id, skill_id=skill_id,
+        started_at=datetime.utcnow(), elapsed_seconds=0, last_heartbeat_at=datetime.utcnow(), status="closed",
+    )
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=["client_session_id"],
+        set_={"status": "closed"},
+        where=(models.OpenSession.status == "open") & (models.OpenSession.user_id == user_id),
+    ))
+    open_session = db.query(models.OpenSession).filter(
+        models.OpenSession.client_session_id == client_session_id,
+        models.OpenSession.user_id == user_id,
+    ).first()
+    if open_session and open_session.session_id:
+        return db.get(models.Session, open_session.session_id)
+    return None
+
 def create_reflection(db: Session, reflection: schemas.ReflectionCreate):
-    db_reflection = models.Reflection(**reflection.dict(), session_id=reflection.session_id)
+    db_reflection = models.Reflection(**reflection.dict())
     db.add(db_reflection)
     db.commit()
     db.refresh(db_reflection)
@@ -59,6 +200,7 @@ def get_skill(db: Session, skill_id: int):
     return db.query(models.Skill).filter(models.Skill.id == skill_id).first()
 
 def check_and_award_badges(db: Session, user_id: int):
+    # Runs as the "award_badges" background task, which commits
     # 1. Calculate Stats
     total_sessions = db.query(models.Session).join(models.Skill).filter(models.Skill.user_id == user_id).count()
     
@@ -84,26 +226,24 @@ def check_and_award_badges(db: Session, user_id: int):
             passed = True
 
         if passed:
-            # Ensure Badge exists in DB
+            # Ensure Badge exists in DB. Two award_badges tasks can run at once,
+            # so inserts skip rows another worker committed in the meantime.
             badge_model = db.query(models.Badge).filter(models.Badge.name == b_def["name"]).first()
             if not badge_model:
-                 badge_model = models.Badge(
+                 db.execute(sqlite_insert(models.Badge).values(
                      name=b_def["name"], 
                      description=b_def["description"], 
                      icon_name=b_def["icon"], 
                      criteria_type=b_def["criteria"], 
                      threshold=b_def["threshold"]
-                 )
-                 db.add(badge_model)
-                 db.commit()
-                 db.refresh(badge_model)
+                 ).on_conflict_do_nothing(index_elements=["name"]))
+                 badge_model = db.query(models.Badge).filter(models.Badge.name == b_def["name"]).first()
 
             # Check if user has it
-            user_badge = db.query(models.UserBadge).filter(models.UserBadge.user_id == user_id, models.UserBadge.badge_id == badge_model.id).first()
-            if not user_badge:
-                ub = models.UserBadge(user_id=user_id, badge_id=badge_model.id)
-                db.add(ub)
-                db.commit()
+            inserted = db.execute(sqlite_insert(models.UserBadge).values(
+                user_id=user_id, badge_id=badge_model.id, earned_at=datetime.utcnow(),
+            ).on_conflict_do_nothing(index_elements=["user_id", "badge_id"]))
+            if inserted.rowcount:
                 new_badges.append(b_def["name"])
 
     return new_badges
@@ -1,19 +1,63 @@
-from sqlalchemy import create_engine
+import os
+import zlib
+from sqlalchemy import create_engine, event
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
+from .core.config import settings
 
-# SQLite database URL
+# Legacy single-file database, only read by `python -m app.rebalance import-legacy`
 SQLALCHEMY_DATABASE_URL = "sqlite:///./sql_app.db"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+os.makedirs(settings.SHARD_DIR, exist_ok=True)
 
+DIRECTORY_DATABASE_URL = f"sqlite:///{settings.SHARD_DIR}/directory.db"
+SHARD_DATABASE_URLS = [
+    f"sqlite:///{settings.SHARD_DIR}/shard_{i}.db" for i in range(settings.SHARD_COUNT)
+]
+
+def create_sqlite_engine(url: str):
+    engine = create_engine(url, connect_args={"check_same_thread": False})
+
+    # WAL lets readers run alongside the single writer of each file
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.close()
+
+    return engine
+
+directory_engine = create_sqlite_engine(DIRECTORY_DATABASE_URL)
+DirectorySessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=directory_engine)
+
+shard_engines = [create_sqlite_engine(url) for url in SHARD_DATABASE_URLS]
+ShardSessionLocals = [
+    sessionmaker(autocommit=False, autoflush=False, bind=e) for e in shard_engines
+]
+
+# Per-user tables (users, skills, sessions, ...) are created in every shard
 Base = declarative_base()
+# Global tables (the user directory) only exist in the directory database
+DirectoryBase = declarative_base()
+
+def shard_for_user(user_id: int, shard_count: int = None) -> int:
+    # crc32 is stable across processes, unlike hash()
+    count = shard_count or settings.SHARD_COUNT
+    return zlib.crc32(str(user_id).encode()) % count
+
+def get_shard_session(shard: int):
+    return ShardSessionLocals[shard]()
+
+def get_directory_db():
+    db = DirectorySessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
 
-def get_db():
-    db = SessionLocal()
+def get_shard_db(shard: int):
+    db = get_shard_session(shard)
     try:
         yield db
     finally:
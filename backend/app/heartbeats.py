@@ -0,0 +1,214 @@
+"""Crash-safe progress for focus sessions without a write per heartbeat.
+
+The focus timer sends `POST /sessions/heartbeat` every few seconds while a
+session is in progress. Heartbeats only update `HeartbeatBuffer`, an
+in-memory map holding the latest state per (user, client_session_id), so
+repeated heartbeats coalesce into one entry. Every
+HEARTBEAT_FLUSH_INTERVAL_SECONDS (sooner once HEARTBEAT_MAX_PENDING entries
+are waiting) the buffer is written to `open_sessions` with one multi-row
+upsert per shard.
+
+The client ends a session normally with `POST /sessions?client_session_id=`,
+which marks the open row "closed" in the same transaction. A closed row is
+never reopened by a late flush. Open rows without a heartbeat for
+HEARTBEAT_TIMEOUT_SECONDS (e.g. a crashed tab) are finalized into regular
+`Session` rows. Both paths link the row to its `Session`. A client that saves
+an already finalized session gets that `Session` back, not a second one. The
+duration of that Session is raised to the client's if the client's is longer.
+
+Entries are written to the user's shard as the directory has it at flush
+time, so a user moved by `app.rebalance` in the meantime does not leave rows
+behind in their old shard.
+"""
+import asyncio
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from . import crud, models, schemas
+from .core.config import settings
+from .database import DirectorySessionLocal, get_shard_session, shard_engines
+from .leaderboard import leaderboard
+
+logger = logging.getLogger(__name__)
+
+FLUSH_CHUNK_SIZE = 100
+
+class HeartbeatBuffer:
+    def __init__(self):
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._loop = None
+        self._wake = None
+        self._stopping = None
+        self._task = None
+
+    def record(self, user_id: int, heartbeat):
+        now = datetime.utcnow()
+        key = (user_id, heartbeat.client_session_id)
+        started_at = heartbeat.started_at
+        if started_at and started_at.tzinfo:
+            # Columns hold naive UTC, like datetime.utcnow() defaults
+            started_at = started_at.astimezone(timezone.utc).replace(tzinfo=None)
+        with self._lock:
+            previous = self._pending.get(key)
+            self._pending[key] = {
+                "client_session_id": heartbeat.client_session_id,
+                "user_id": user_id,
+                "skill_id": heartbeat.skill_id,
+                "started_at": previous["started_at"] if previous else (started_at or now),
+                "elapsed_seconds": max(heartbeat.elapsed_seconds, previous["elapsed_seconds"] if previous else 0),
+                "last_heartbeat_at": now,
+            }
+            full = len(self._pending) >= settings.HEARTBEAT_MAX_PENDING
+        if full and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    def discard(self, user_id: int, client_session_id: str):
+        with self._lock:
+            self._pending.pop((user_id, client_session_id), None)
+
+    def _group_by_shard(self, entries):
+        user_ids = {entry["user_id"] for entry in entries}
+        directory = DirectorySessionLocal()
+        try:
+            directory_entries = directory.query(models.UserDirectory).filter(models.UserDirectory.id.in_(user_ids)).all()
+        finally:
+            directory.close()
+        owners = {e.id: e for e in directory_entries}
+
+        by_shard, moving = {}, []
+        for entry in entries:
+            owner = owners.get(entry["user_id"])
+            if owner is None:
+                continue
+            if owner.moving:
+                # Written once the move is done, to the user's new shard
+                moving.append(entry)
+                continue
+            by_shard.setdefault(owner.shard, []).append(entry)
+        return by_shard, moving
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            by_shard, moving = self._group_by_shard(list(pending.values()))
+        except Exception:
+            self._requeue(pending.values())
+            raise
+        self._requeue(moving)
+
+        for shard, entries in by_shard.items():
+            db = get_shard_session(shard)
+            try:
+                # Chunked to stay under SQLite's bound-parameter limit
+                for i in range(0, len(entries), FLUSH_CHUNK_SIZE):
+                    stmt = sqlite_insert(models.OpenSession).values(entries[i:i + FLUSH_CHUNK_SIZE])
+                    stmt = stmt.on_conflict_do_update(
+                        index_elements=["client_session_id"],
+                        set_={
+                            "elapsed_seconds": func.max(models.OpenSession.elapsed_seconds, stmt.excluded.elapsed_seconds),
+                            "last_heartbeat_at": stmt.excluded.last_heartbeat_at,
+                        },
+                        # Never reopen a closed/finalized session or touch another user's row
+                        where=(models.OpenSession.status == "open")
+                        & (models.OpenSession.user_id == stmt.excluded.user_id),
+                    )
+                    db.execute(stmt)
+                db.commit()
+            except Exception:
+                db.rollback()
+                logger.exception("Heartbeat flush failed on shard %s", shard)
+                self._requeue(entries)
+            finally:
+                db.close()
+        return len(pending)
+
+    def _requeue(self, entries):
+        with self._lock:
+            for entry in entries:
+                self._pending.setdefault((entry["user_id"], entry["client_session_id"]), entry)
+
+    def finalize_stale(self, now: datetime = None):
+        now = now or datetime.utcnow()
+        cutoff = now - timedelta(seconds=settings.HEARTBEAT_TIMEOUT_SECONDS)
+        finalized = 0
+        for shard in range(len(shard_engines)):
+            db = get_shard_session(shard)
+            try:
+                stale = db.query(models.OpenSession).filter(
+                    models.OpenSession.status == "open",
+                    models.OpenSession.last_heartbeat_at < cutoff,
+                ).all()
+                recorded = []
+                for open_session in stale:
+                    # Conditional claim: POST /sessions may have closed the row
+                    # (or a heartbeat revived it) since it was read above
+                    claimed = db.query(models.OpenSession).filter(
+                        models.OpenSession.id == open_session.id,
+                        models.OpenSession.status == "open",
+                        models.OpenSession.last_heartbeat_at < cutoff,
+                    ).update({models.OpenSession.status: "finalized"}, synchronize_session=False)
+                    if not claimed:
+                        continue
+                    db.refresh(open_session)
+                    # Same rounding as the focus timer; under a minute is not a session
+                    minutes = min(open_session.elapsed_seconds // 60, schemas.MAX_SESSION_MINUTES)
+                    skill = crud.get_skill(db, open_session.skill_id)
+                    # Skill ids are reused once a user moves shards
+                    if minutes < 1 or not skill or skill.user_id != open_session.user_id:
+                        continue
+                    db_session = models.Session(skill_id=skill.id, date=open_session.started_at, duration_minutes=minutes)
+                    db.add(db_session)
+                    db.flush()
+                    open_session.session_id = db_session.id
+                    crud.enqueue_task(db, "award_badges", {"user_id": open_session.user_id})
+                    recorded.append((db_session, skill))
+                # Finished rows are only kept around to block late flushes
+                db.query(models.OpenSession).filter(
+                    models.OpenSession.status != "open",
+                    models.OpenSession.last_heartbeat_at < now - timedelta(days=1),
+                ).delete(synchronize_session=False)
+                db.commit()
+                for db_session, skill in recorded:
+                    leaderboard.record_session(shard, db_session, skill, skill.owner)
+                finalized += len(recorded)
+            finally:
+                db.close()
+        return finalized
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._stopping = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._stopping is None:
+            return
+        self._stopping.set()
+        self._wake.set()
+        await self._task
+        # Progress buffered since the last flush must survive a restart
+        await asyncio.to_thread(self.flush)
+
+    async def _run(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=settings.HEARTBEAT_FLUSH_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            if self._stopping.is_set():
+                break
+            try:
+                await asyncio.to_thread(self.flush)
+                await asyncio.to_thread(self.finalize_stale)
+            except Exception:
+                logger.exception("Heartbeat maintenance failed")
+
+heartbeat_buffer = HeartbeatBuffer()
@@ -0,0 +1,336 @@
+"""In-memory leaderboards over practice minutes.
+
+There is one board per (scope, window): scope is "global" or a normalized
+skill name, and window is the current ISO week, the current month or
+"all". Each board keeps a user -> minutes map plus a Fenwick tree that
+counts users per minute score:
+
+* rank / percentile of a user: one prefix-sum query, O(log M)
+* top K: K order-statistic lookups, O(K log M)
+* a new session: one point update per affected board, O(log M)
+
+where M is the highest score on the board. Sessions are applied as they are
+logged. The boards are snapshotted to LEADERBOARD_SNAPSHOT_PATH together with
+the highest applied session id per shard and the minutes applied for each of
+the last REPLAY_MARGIN ids below it. Sessions are recorded after their commit,
+so they can arrive out of id order or, after a crash, not at all. On restart,
+replay therefore starts REPLAY_MARGIN ids below the highest one and skips
+sessions that were already applied. A session whose minutes grew since it was
+applied (a finalized session the client saved later) adds only the
+difference. A full rebuild happens only when there is
+no snapshot. Compaction drops boards of windows that have ended.
+
+Moving a user to another shard gives their sessions new ids, which makes the
+watermarks wrong. `python -m app.rebalance` therefore bumps the shard
+generation in the directory database, and every snapshot records the
+generation it was built at. A snapshot from another generation is ignored on
+load. A running app that sees the generation change rebuilds its boards
+before it writes the next snapshot.
+"""
+import asyncio
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+from . import crud, models, schemas
+from .core.config import settings
+from .database import DirectorySessionLocal, get_shard_session, shard_engines
+
+logger = logging.getLogger(__name__)
+
+LEADERBOARD_SNAPSHOT_PATH = os.path.join(settings.SHARD_DIR, "leaderboard.json")
+WINDOWS = ("week", "month", "all")
+GLOBAL_SCOPE = "global"
+# How far below the highest applied session id replay looks for missed sessions
+REPLAY_MARGIN = 1000
+
+def skill_scope(skill_name: str):
+    return "skill:" + " ".join(skill_name.lower().split())
+
+def window_key(window: str, when: datetime):
+    if window == "week":
+        year, week, _ = when.isocalendar()
+        return f"week:{year}-W{week:02d}"
+    if window == "month":
+        return f"month:{when.year}-{when.month:02d}"
+    return "all"
+
+def current_generation():
+    directory = DirectorySessionLocal()
+    try:
+        return crud.get_shard_generation(directory)
+    finally:
+        directory.close()
+
+class FenwickTree:
+    """Counts per integer score, 1-indexed, growing by doubling."""
+
+    def __init__(self, size: int = 64):
+        self.size = size
+        self.tree = [0] * (size + 1)
+
+    def _grow(self, index: int):
+        counts = [self.range_count(i, i) for i in range(1, self.size + 1)]
+        size = self.size
+        while size < index:
+            size *= 2
+        # Allocate before touching self: a failed allocation leaves the tree usable
+        tree = [0] * (size + 1)
+        self.size, self.tree = size, tree
+        for i, count in enumerate(counts, start=1):
+            if count:
+                self.add(i, count)
+
+    def add(self, index: int, delta: int):
+        if index > self.size:
+            self._grow(index)
+        while index <= self.size:
+            self.tree[index] += delta
+            index += index & -index
+
+    def prefix(self, index: int):
+        index = min(index, self.size)
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def range_count(self, low: int, high: int):
+        return self.prefix(high) - self.prefix(low - 1)
+
+    def find_kth(self, k: int):
+        # Smallest index whose prefix sum reaches k
+        position = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            nxt = position + step
+            if nxt <= self.size and self.tree[nxt] < k:
+                position = nxt
+                k -= self.tree[nxt]
+            step >>= 1
+        return position + 1
+
+class RankedBoard:
+    def __init__(self):
+        self.scores = {}
+        self.buckets = {}
+        self.tree = FenwickTree()
+
+    def add(self, user_id: int, minutes: int):
+        old = self.scores.get(user_id, 0)
+        new = old + minutes
+        if new <= 0 or new == old:
+            return
+        # Insert first: if growing the tree fails, the board is left unchanged
+        self.tree.add(new, 1)
+        if old:
+            self.tree.add(old, -1)
+            self.buckets[old].discard(user_id)
+            if not self.buckets[old]:
+                del self.buckets[old]
+        self.scores[user_id] = new
+        self.buckets.setdefault(new, set()).add(user_id)
+
+    def rank(self, user_id: int):
+        score = self.scores.get(user_id)
+        if score is None:
+            return None
+        total = len(self.scores)
+        higher = total - self.tree.prefix(score)
+        lower = self.tree.prefix(score - 1)
+        return {
+            "rank": higher + 1,
+            "minutes": score,
+            "percentile": round(100 * lower / (total - 1), 1) if total > 1 else 100.0,
+            "total_users": total,
+        }
+
+    def top(self, k: int):
+        entries = []
+        remaining = len(self.scores)
+        while remaining and len(entries) < k:
+            score = self.tree.find_kth(remaining)
+            users = self.buckets[score]
+            rank = len(self.scores) - remaining + 1
+            for user_id in sorted(users)[:k - len(entries)]:
+                entries.append((rank, user_id, score))
+            remaining -= len(users)
+        return entries
+
+class Leaderboard:
+    def __init__(self, snapshot_path: str = LEADERBOARD_SNAPSHOT_PATH):
+        self.snapshot_path = snapshot_path
+        self.boards = {}
+        self.usernames = {}
+        self.watermarks = {}
+        self.applied = {}
+        self.generation = None
+        self._lock = threading.Lock()
+        self._stopping = None
+        self._maintenance = None
+
+    def _apply(self, shard: int, session_id: int, user_id: int, username: str, skill_name: str, minutes: int, when: datetime):
+        applied = self.applied.setdefault(shard, {})
+        if session_id <= self.watermarks.get(shard, 0) - REPLAY_MARGIN:
+            return False
+        # Sessions stored before SessionCreate was bounded could be arbitrarily long
+        minutes = min(minutes, schemas.MAX_SESSION_MINUTES)
+        delta = minutes - applied.get(session_id, 0)
+        if session_id in applied and delta <= 0:
+            return False
+        self.usernames[user_id] = username
+        for scope in (GLOBAL_SCOPE, skill_scope(skill_name)):
+            for window in WINDOWS:
+                key = (scope, window_key(window, when))
+                board = self.boards.get(key)
+                if board is None:
+                    board = self.boards[key] = RankedBoard()
+                board.add(user_id, delta)
+        applied[session_id] = minutes
+        self.watermarks[shard] = max(self.watermarks.get(shard, 0), session_id)
+        if len(applied) > 2 * REPLAY_MARGIN:
+            floor = self.watermarks[shard] - REPLAY_MARGIN
+            self.applied[shard] = {i: m for i, m in applied.items() if i > floor}
+        return True
+
+    def record_session(self, shard: int, session: models.Session, skill: models.Skill, user: models.User):
+        with self._lock:
+            self._apply(shard, session.id, user.id, user.username, skill.name, session.duration_minutes, session.date)
+
+    def top(self, window: str = "week", skill_name: str = None, limit: int = 10, now: datetime = None):
+        scope = skill_scope(skill_name) if skill_name else GLOBAL_SCOPE
+        with self._lock:
+            board = self.boards.get((scope, window_key(window, now or datetime.utcnow())))
+            if board is None:
+                return []
+            return [
+                {"rank": rank, "user_id": user_id, "username": self.usernames.get(user_id), "minutes": minutes}
+                for rank, user_id, minutes in board.top(limit)
+            ]
+
+    def rank(self, user_id: int, window: str = "week", skill_name: str = None, now: datetime = None):
+        scope = skill_scope(skill_name) if skill_name else GLOBAL_SCOPE
+        with self._lock:
+            board = self.boards.get((scope, window_key(window, now or datetime.utcnow())))
+            return board.rank(user_id) if board else None
+
+    def compact(self, now: datetime = None):
+        now = now or datetime.utcnow()
+        current = {window_key(window, now) for window in WINDOWS}
+        with self._lock:
+            for key in [key for key in self.boards if key[1] not in current]:
+                del self.boards[key]
+
+    def catch_up(self):
+        """Apply sessions missing from the snapshot (all of them without one)."""
+        applied = 0
+        for shard in range(len(shard_engines)):
+            db = get_shard_session(shard)
+            try:
+                rows = db.query(
+                    models.Session.id, models.Session.duration_minutes, models.Session.date,
+                    models.Skill.name, models.User.id, models.User.username,
+                ).join(models.Skill, models.Session.skill_id == models.Skill.id).join(
+                    models.User, models.Skill.user_id == models.User.id
+                ).filter(
+                    models.Session.id > self.watermarks.get(shard, 0) - REPLAY_MARGIN
+                ).order_by(models.Session.id).yield_per(1000)
+                with self._lock:
+                    for session_id, minutes, when, skill_name, user_id, username in rows:
+                        if self._apply(shard, session_id, user_id, username, skill_name, minutes or 0, when):
+                            applied += 1
+            finally:
+                db.close()
+        return applied
+
+    def save_snapshot(self):
+        with self._lock:
+            data = {
+                "generation": self.generation,
+                "watermarks": self.watermarks,
+                "applied": self.applied,
+                "usernames": self.usernames,
+                "boards": [
+                    {"scope": scope, "window": window, "scores": board.scores}
+                    for (scope, window), board in self.boards.items()
+                ],
+            }
+            payload = json.dumps(data)
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(payload)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def load_snapshot(self):
+        if not os.path.exists(self.snapshot_path):
+            return False
+        with open(self.snapshot_path) as f:
+            data = json.load(f)
+        if data.get("generation") != self.generation:
+            logger.info("Leaderboard snapshot predates a shard rebalance, rebuilding from sessions")
+            return False
+        with self._lock:
+            # JSON object keys are strings
+            self.watermarks = {int(shard): session_id for shard, session_id in data["watermarks"].items()}
+            self.applied = {
+                int(shard): {int(session_id): minutes for session_id, minutes in applied.items()}
+                for shard, applied in data["applied"].items()
+            }
+            self.usernames = {int(user_id): name for user_id, name in data["usernames"].items()}
+            self.boards = {}
+            for item in data["boards"]:
+                board = self.boards[(item["scope"], item["window"])] = RankedBoard()
+                for user_id, minutes in item["scores"].items():
+                    board.add(int(user_id), minutes)
+        return True
+
+    def rebuild(self, generation: int):
+        fresh = Leaderboard(self.snapshot_path)
+        fresh.generation = generation
+        fresh.catch_up()
+        with self._lock:
+            self.boards, self.usernames, self.watermarks, self.applied = (
+                fresh.boards, fresh.usernames, fresh.watermarks, fresh.applied
+            )
+            self.generation = generation
+        # Sessions recorded while the fresh boards were built went to the old ones
+        self.catch_up()
+
+    async def start(self):
+        self.generation = await asyncio.to_thread(current_generation)
+        try:
+            await asyncio.to_thread(self.load_snapshot)
+        except (OSError, ValueError, KeyError, MemoryError):
+            logger.exception("Unreadable leaderboard snapshot, rebuilding from sessions")
+            self.boards, self.usernames, self.watermarks, self.applied = {}, {}, {}, {}
+        await asyncio.to_thread(self.catch_up)
+        self.compact()
+        self._stopping = asyncio.Event()
+        self._maintenance = asyncio.create_task(self._run_maintenance())
+
+    async def stop(self):
+        if self._stopping is None:
+            return
+        # The maintenance loop wakes up and writes a final snapshot
+        self._stopping.set()
+        await self._maintenance
+
+    async def _run_maintenance(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=settings.LEADERBOARD_SNAPSHOT_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                generation = await asyncio.to_thread(current_generation)
+                if generation != self.generation:
+                    # app.rebalance moved users since the boards were built
+                    await asyncio.to_thread(self.rebuild, generation)
+                self.compact()
+                await asyncio.to_thread(self.save_snapshot)
+            except Exception:
+                logger.exception("Leaderboard snapshot failed")
+
+leaderboard = Leaderboard()
@@ -1,12 +1,35 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
-from .database import engine
-from . import models
-from .routers import auth, skills, sessions
+from .database import directory_engine, get_shard_session, shard_engines
+from . import crud, models
+from .heartbeats import heartbeat_buffer
+from .leaderboard import leaderboard
+from .routers import auth, skills, sessions, leaderboards
+from .search import ensure_reflection_index
+from .tasks import task_runner
 from fastapi.middleware.cors import CORSMiddleware
 
-models.Base.metadata.create_all(bind=engine)
+models.DirectoryBase.metadata.create_all(bind=directory_engine)
+for shard, shard_engine in enumerate(shard_engines):
+    models.Base.metadata.create_all(bind=shard_engine)
+    ensure_reflection_index(shard_engine)
+    db = get_shard_session(shard)
+    try:
+        crud.migrate_legacy_resources(db)
+    finally:
+        db.close()
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await leaderboard.start()
+    await task_runner.start()
+    await heartbeat_buffer.start()
+    yield
+    await heartbeat_buffer.stop()
+    await task_runner.stop()
+    await leaderboard.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS Middleware
 origins = [
@@ -25,6 +48,7 @@ app.add_middleware(
 app.include_router(auth.router)
 app.include_router(skills.router)
 app.include_router(sessions.router)
+app.include_router(leaderboards.router)
 
 @app.get("/")
 def read_root():
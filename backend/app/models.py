@@ -1,7 +1,23 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Text, JSON
+from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, DateTime, Text, JSON, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from datetime import datetime
-from .database import Base
+from .database import Base, DirectoryBase
+
+class UserDirectory(DirectoryBase):
+    __tablename__ = "user_directory"
+
+    id = Column(Integer, primary_key=True, index=True) # Global user id, reused as users.id in the shard
+    email = Column(String, unique=True, index=True)
+    shard = Column(Integer, index=True)
+    moving = Column(Boolean, default=False) # Set by app.rebalance while the user's rows are copied
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class ShardLayout(DirectoryBase):
+    __tablename__ = "shard_layout"
+
+    id = Column(Integer, primary_key=True) # Single row
+    generation = Column(Integer, default=0) # Bumped by app.rebalance whenever users change shards
+
 
 class User(Base):
     __tablename__ = "users"
@@ -45,9 +61,41 @@ class DailyPlan(Base):
     action_task = Column(Text)
     suggested_duration_minutes = Column(Integer)
     scheduled_date = Column(DateTime, nullable=True) # For dynamic scheduling
-    resources = Column(JSON, default=list) # [{title, url, type}]
+    # Pre-plan_resources storage, emptied by crud.migrate_legacy_resources
+    # none_as_null: None must be stored as SQL NULL, not the JSON text 'null'
+    legacy_resources = Column("resources", JSON(none_as_null=True), nullable=True) # [{title, url, type}]
     
     skill = relationship("Skill", back_populates="daily_plans")
+    resource_links = relationship("PlanResource", back_populates="plan", order_by="PlanResource.id", cascade="all, delete-orphan")
+
+    @property
+    def resources(self):
+        return [link.as_dict() for link in self.resource_links]
+
+
+class ResourceUrl(Base):
+    __tablename__ = "resource_urls"
+
+    id = Column(Integer, primary_key=True, index=True)
+    url = Column(String, unique=True, index=True) # Shared by every plan linking to it
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class PlanResource(Base):
+    __tablename__ = "plan_resources"
+
+    id = Column(Integer, primary_key=True, index=True)
+    plan_id = Column(Integer, ForeignKey("daily_plans.id"), index=True)
+    resource_url_id = Column(Integer, ForeignKey("resource_urls.id"))
+    title = Column(String)
+    type = Column(String, default="link")
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    plan = relationship("DailyPlan", back_populates="resource_links")
+    resource_url = relationship("ResourceUrl")
+
+    def as_dict(self):
+        return {"title": self.title, "url": self.resource_url.url, "type": self.type}
 
 
 class Session(Base):
@@ -90,6 +138,8 @@ class Badge(Base):
 
 class UserBadge(Base):
     __tablename__ = "user_badges"
+    # Lets concurrent award_badges tasks insert with ON CONFLICT DO NOTHING
+    __table_args__ = (UniqueConstraint("user_id", "badge_id"),)
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"))
@@ -108,3 +158,35 @@ class SkillFreeze(Base):
     date = Column(DateTime, default=datetime.utcnow) # The date frozen
     
     skill = relationship("Skill", back_populates="freezes")
+
+
+class OutboxTask(Base):
+    __tablename__ = "outbox_tasks"
+    __table_args__ = (Index("ix_outbox_tasks_status_run_after", "status", "run_after"),)
+
+    id = Column(Integer, primary_key=True, index=True)
+    name = Column(String)
+    payload = Column(JSON, default=dict)
+    idempotency_key = Column(String, unique=True, nullable=True)
+    status = Column(String, default="pending") # pending, running, done, failed
+    attempts = Column(Integer, default=0)
+    max_attempts = Column(Integer, default=5)
+    run_after = Column(DateTime, default=datetime.utcnow)
+    locked_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+
+class OpenSession(Base):
+    __tablename__ = "open_sessions"
+
+    id = Column(Integer, primary_key=True, index=True)
+    client_session_id = Column(String, unique=True, index=True) # Generated by the focus timer
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    skill_id = Column(Integer, ForeignKey("skills.id"))
+    started_at = Column(DateTime, default=datetime.utcnow)
+    elapsed_seconds = Column(Integer, default=0)
+    last_heartbeat_at = Column(DateTime, default=datetime.utcnow, index=True)
+    status = Column(String, default="open") # open, closed (saved by the client), finalized
+    session_id = Column(Integer, ForeignKey("sessions.id"), nullable=True) # The Session it was recorded as
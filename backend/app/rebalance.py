@@ -0,0 +1,327 @@
+"""Shard maintenance tooling.
+
+Usage (from the backend directory):
+
+    python -m app.rebalance status
+    python -m app.rebalance plan                 # users not on their hashed shard
+    python -m app.rebalance apply                # move them, then purge stale copies
+    python -m app.rebalance move <email> <shard>
+    python -m app.rebalance import-legacy [--source sqlite:///./sql_app.db]
+
+After raising SHARD_COUNT, `apply` moves every user to
+shard_for_user(id) under the new count. A move first flags the directory
+entry as moving, so the API answers 503 for that user, and waits
+SHARD_MOVE_DRAIN_SECONDS for in-flight requests. It then copies the user's
+rows into the target shard. Holding the source shard's write lock, it checks
+that the user's rows did not change during the copy before it switches the
+directory entry and deletes the source rows. If they changed, the copy is
+discarded and the move fails. A crash at any point leaves the directory
+pointing at a complete copy; rerunning the command clears a leftover moving
+flag. SHARD_COUNT can only grow: the files of removed shards would no longer
+be reachable.
+"""
+import argparse
+import hashlib
+import sqlite3
+import time
+from sqlalchemy import create_engine, func, inspect, text
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import sessionmaker
+from . import crud, models, schemas
+from .database import (
+    DirectorySessionLocal,
+    directory_engine,
+    get_shard_session,
+    shard_engines,
+    shard_for_user,
+    SQLALCHEMY_DATABASE_URL,
+)
+from .core.config import settings
+from .search import ensure_reflection_index
+
+def _clone(obj, **overrides):
+    mapper = inspect(obj).mapper
+    data = {attr.key: getattr(obj, attr.key) for attr in mapper.column_attrs if not attr.columns[0].primary_key}
+    data.update(overrides)
+    return type(obj)(**data)
+
+def _get_or_copy_badge(dst, badge):
+    existing = dst.query(models.Badge).filter(models.Badge.name == badge.name).first()
+    if existing:
+        return existing
+    copy = _clone(badge)
+    dst.add(copy)
+    dst.flush()
+    return copy
+
+def _user_fingerprint(db, user_id: int):
+    """Digest of every row the user owns, to detect writes during a move."""
+    digest = hashlib.sha256()
+    rows = [db.query(models.User).filter(models.User.id == user_id).first()]
+    rows += db.query(models.UserBadge).filter(models.UserBadge.user_id == user_id).order_by(models.UserBadge.id).all()
+    for skill in db.query(models.Skill).filter(models.Skill.user_id == user_id).order_by(models.Skill.id).all():
+        rows.append(skill)
+        rows += skill.daily_plans + skill.freezes
+        for plan in skill.daily_plans:
+            rows += plan.resource_links
+        for session in skill.sessions:
+            rows.append(session)
+            rows += session.reflections
+    for row in rows:
+        if row is None:
+            continue
+        mapper = inspect(row).mapper
+        digest.update(repr([(attr.key, getattr(row, attr.key)) for attr in mapper.column_attrs]).encode())
+    return digest.hexdigest()
+
+def copy_user_rows(src, dst, user_id: int, new_user_id: int = None, legacy: bool = False):
+    """Copy a user and everything they own from `src` into `dst`.
+
+    The user keeps its global id (or takes `new_user_id`); skills, plans,
+    sessions etc. get fresh ids in the target shard since those are only
+    unique per shard. A `legacy` source predates plan_resources and keeps
+    resources in the plan's JSON column only.
+    """
+    user = src.query(models.User).filter(models.User.id == user_id).first()
+    if not user:
+        return False
+
+    new_user_id = new_user_id or user.id
+    dst.add(_clone(user, id=new_user_id))
+    dst.flush()
+
+    for skill in src.query(models.Skill).filter(models.Skill.user_id == user_id).all():
+        new_skill = _clone(skill, user_id=new_user_id)
+        dst.add(new_skill)
+        dst.flush()
+        for plan in skill.daily_plans:
+            new_plan = _clone(plan, skill_id=new_skill.id)
+            dst.add(new_plan)
+            dst.flush()
+            for link in ([] if legacy else plan.resource_links):
+                crud.add_plan_resource(dst, new_plan.id, schemas.PlanResourceCreate(**link.as_dict()))
+        for freeze in skill.freezes:
+            dst.add(_clone(freeze, skill_id=new_skill.id))
+        for session in skill.sessions:
+            new_session = _clone(session, skill_id=new_skill.id)
+            dst.add(new_session)
+            dst.flush()
+            for reflection in session.reflections:
+                dst.add(_clone(reflection, session_id=new_session.id))
+        # Outbox tasks are not copied; reschedule a plan that was still pending
+        if new_skill.status == "active" and not skill.daily_plans:
+            crud.schedule_plan_generation(dst, new_skill.id)
+
+    copied_badges = set()
+    for user_badge in src.query(models.UserBadge).filter(models.UserBadge.user_id == user_id).all():
+        badge = _get_or_copy_badge(dst, user_badge.badge)
+        # Older databases may hold the same badge twice for a user
+        if badge.id in copied_badges:
+            continue
+        copied_badges.add(badge.id)
+        dst.add(_clone(user_badge, user_id=new_user_id, badge_id=badge.id))
+    crud.enqueue_task(dst, "award_badges", {"user_id": new_user_id})
+
+    dst.flush()
+    return True
+
+def delete_user_tasks(db, user_id: int, skill_ids):
+    user_tasks = db.query(models.OutboxTask).filter(
+        (func.json_extract(models.OutboxTask.payload, "$.user_id") == user_id)
+        | (func.json_extract(models.OutboxTask.payload, "$.skill_id").in_(skill_ids))
+    )
+    # A running task is left to finish, but it must not keep its key: skill ids
+    # are reused in this shard and would be deduped against it
+    user_tasks.filter(models.OutboxTask.status == "running").update(
+        {models.OutboxTask.idempotency_key: None}, synchronize_session=False
+    )
+    user_tasks.filter(models.OutboxTask.status != "running").delete(synchronize_session=False)
+
+def delete_user_rows(db, user_id: int):
+    skills = db.query(models.Skill).filter(models.Skill.user_id == user_id).all()
+    delete_user_tasks(db, user_id, [skill.id for skill in skills])
+    # Skill cascades take care of plans, sessions, reflections and freezes
+    for skill in skills:
+        db.delete(skill)
+    db.query(models.UserBadge).filter(models.UserBadge.user_id == user_id).delete()
+    db.query(models.OpenSession).filter(models.OpenSession.user_id == user_id).delete()
+    db.query(models.User).filter(models.User.id == user_id).delete()
+    db.flush()
+
+class UserChangedDuringMove(Exception):
+    pass
+
+def _set_moving(directory, entry, moving: bool):
+    entry.moving = moving
+    directory.commit()
+
+def move_user(directory, user_id: int, target_shard: int):
+    entry = crud.get_directory_entry(directory, user_id)
+    if not entry:
+        return False
+    if entry.shard == target_shard:
+        # Leftover flag from an interrupted move
+        if entry.moving:
+            _set_moving(directory, entry, False)
+        return False
+
+    source_shard = entry.shard
+    _set_moving(directory, entry, True)
+    time.sleep(settings.SHARD_MOVE_DRAIN_SECONDS)
+
+    src = get_shard_session(source_shard)
+    dst = get_shard_session(target_shard)
+    try:
+        # A previous interrupted move may have left a partial copy behind
+        delete_user_rows(dst, user_id)
+        fingerprint = _user_fingerprint(src, user_id)
+        copy_user_rows(src, dst, user_id)
+        dst.commit()
+        src.rollback()
+
+        # A no-op write takes the source write lock: from here on nothing
+        # can change the user's rows until the source is cleaned up.
+        src.execute(text("UPDATE users SET id = id WHERE id = :user_id"), {"user_id": user_id})
+        if _user_fingerprint(src, user_id) != fingerprint:
+            src.rollback()
+            delete_user_rows(dst, user_id)
+            dst.commit()
+            _set_moving(directory, entry, False)
+            raise UserChangedDuringMove(f"user {user_id} was written to during the move, nothing moved")
+
+        entry.shard = target_shard
+        entry.moving = False
+        directory.commit()
+
+        delete_user_rows(src, user_id)
+        src.commit()
+    finally:
+        src.close()
+        dst.close()
+    return True
+
+def plan_moves(directory):
+    moves = []
+    for entry in directory.query(models.UserDirectory).order_by(models.UserDirectory.id).all():
+        target = shard_for_user(entry.id)
+        if entry.shard != target:
+            moves.append((entry.id, entry.email, entry.shard, target))
+    return moves
+
+def purge_stale_rows(directory):
+    """Delete users found in a shard the directory does not assign them to."""
+    owners = {e.id: e.shard for e in directory.query(models.UserDirectory).all()}
+    purged = 0
+    for shard in range(len(shard_engines)):
+        db = get_shard_session(shard)
+        try:
+            for (user_id,) in db.query(models.User.id).all():
+                if owners.get(user_id) != shard:
+                    delete_user_rows(db, user_id)
+                    purged += 1
+            db.commit()
+        finally:
+            db.close()
+    return purged
+
+def shard_counts(directory):
+    counts = {shard: 0 for shard in range(len(shard_engines))}
+    for entry in directory.query(models.UserDirectory).all():
+        counts[entry.shard] = counts.get(entry.shard, 0) + 1
+    return counts
+
+def import_legacy(directory, source_url: str = SQLALCHEMY_DATABASE_URL):
+    """Distribute users of the old single-file database over the shards."""
+    # Read-only and without the WAL pragma: the legacy file is never modified
+    legacy_path = make_url(source_url).database
+    legacy_engine = create_engine(
+        "sqlite://",
+        creator=lambda: sqlite3.connect(f"file:{legacy_path}?mode=ro", uri=True, check_same_thread=False),
+    )
+    LegacySession = sessionmaker(autocommit=False, autoflush=False, bind=legacy_engine)
+    src = LegacySession()
+    imported = 0
+    try:
+        for user in src.query(models.User).order_by(models.User.id).all():
+            if crud.get_directory_entry_by_email(directory, user.email):
+                continue
+            # Keep the legacy id unless a signup on the sharded setup already took it
+            if crud.get_directory_entry(directory, user.id):
+                entry = crud.create_directory_entry(directory, email=user.email)
+            else:
+                entry = models.UserDirectory(id=user.id, email=user.email, shard=shard_for_user(user.id))
+                directory.add(entry)
+                directory.flush()
+            entry.created_at = user.created_at
+            dst = get_shard_session(entry.shard)
+            try:
+                delete_user_rows(dst, entry.id)
+                copy_user_rows(src, dst, user.id, new_user_id=entry.id, legacy=True)
+                dst.commit()
+                # Copied plans still carry their resources as JSON
+                crud.migrate_legacy_resources(dst)
+                directory.commit()
+            finally:
+                dst.close()
+            imported += 1
+    finally:
+        src.close()
+    return imported
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.rebalance")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("status")
+    sub.add_parser("plan")
+    sub.add_parser("apply")
+    move = sub.add_parser("move")
+    move.add_argument("email")
+    move.add_argument("shard", type=int)
+    legacy = sub.add_parser("import-legacy")
+    legacy.add_argument("--source", default=SQLALCHEMY_DATABASE_URL)
+    args = parser.parse_args(argv)
+
+    models.DirectoryBase.metadata.create_all(bind=directory_engine)
+    for shard_engine in shard_engines:
+        models.Base.metadata.create_all(bind=shard_engine)
+        ensure_reflection_index(shard_engine)
+
+    directory = DirectorySessionLocal()
+    try:
+        if args.command == "status":
+            for shard, count in sorted(shard_counts(directory).items()):
+                print(f"shard {shard}: {count} users")
+        elif args.command == "plan":
+            for user_id, email, src, dst in plan_moves(directory):
+                print(f"{user_id} {email}: {src} -> {dst}")
+        elif args.command == "apply":
+            moves = plan_moves(directory)
+            moved = 0
+            for user_id, email, src, dst in moves:
+                try:
+                    move_user(directory, user_id, dst)
+                except UserChangedDuringMove as exc:
+                    print(f"skipped {email}: {exc}, rerun apply")
+                    continue
+                moved += 1
+                print(f"moved {email}: {src} -> {dst}")
+            print(f"{moved} users moved, {purge_stale_rows(directory)} stale copies purged")
+        elif args.command == "move":
+            if not 0 <= args.shard < settings.SHARD_COUNT:
+                parser.error(f"shard must be between 0 and {settings.SHARD_COUNT - 1}")
+            entry = crud.get_directory_entry_by_email(directory, args.email)
+            if not entry:
+                parser.error(f"unknown user {args.email}")
+            moved = move_user(directory, entry.id, args.shard)
+            print(f"moved {args.email} to shard {args.shard}" if moved else "nothing to do")
+        elif args.command == "import-legacy":
+            print(f"{import_legacy(directory, args.source)} users imported")
+    finally:
+        if args.command in ("apply", "move", "import-legacy"):
+            # Moved sessions get new ids: leaderboard snapshots of the previous
+            # generation are rebuilt, by the running app too
+            crud.bump_shard_generation(directory)
+        directory.close()
+
+if __name__ == "__main__":
+    main()
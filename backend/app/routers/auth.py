@@ -3,8 +3,8 @@ from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 from .. import crud, models, schemas
-from ..database import get_db
-from ..core.security import create_access_token, verify_password, settings
+from ..database import get_directory_db, get_shard_db, get_shard_session
+from ..core.security import create_access_token, get_password_hash, verify_password, settings
 from jose import JWTError, jwt
 
 router = APIRouter()
@@ -12,16 +12,41 @@ router = APIRouter()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token") # "token" is the endpoint url
 
 @router.post("/auth/signup", response_model=schemas.User)
-def signup(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_email(db, email=user.email)
-    if db_user:
+def signup(user: schemas.UserCreate, directory: Session = Depends(get_directory_db)):
+    if crud.get_directory_entry_by_email(directory, email=user.email):
         raise HTTPException(status_code=400, detail="Email already registered")
-    return crud.create_user(db=db, user=user)
+
+    # bcrypt is slow: hash before taking the directory's write lock, which
+    # every signup shares
+    hashed_password = get_password_hash(user.password)
+
+    # The directory row stays uncommitted until the user exists in its shard,
+    # so a failed shard write never leaves a dangling email reservation.
+    entry = crud.create_directory_entry(directory, email=user.email)
+    db = get_shard_session(entry.shard)
+    try:
+        db_user = crud.create_user(db=db, user=user, user_id=entry.id, hashed_password=hashed_password)
+        try:
+            directory.commit()
+        except Exception:
+            db.delete(db_user)
+            db.commit()
+            raise
+        return db_user
+    finally:
+        db.close()
 
 @router.post("/auth/token", response_model=schemas.Token)
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = crud.get_user_by_email(db, email=form_data.username) # OAuth2 form uses 'username' field, which in our case is email depending on how we want it. Standard OAuth2PasswordRequestForm expects 'username' and 'password'.
-    # If we want to use email as username, the client should send email in 'username' field.
+def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), directory: Session = Depends(get_directory_db)):
+    # OAuth2 form uses 'username' field, the client sends the email in it.
+    entry = crud.get_directory_entry_by_email(directory, email=form_data.username)
+    user = None
+    if entry:
+        db = get_shard_session(entry.shard)
+        try:
+            user = crud.get_user(db, entry.id)
+        finally:
+            db.close()
     if not user or not verify_password(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -34,7 +59,7 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db:
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+def get_current_directory_entry(token: str = Depends(oauth2_scheme), directory: Session = Depends(get_directory_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -48,7 +73,29 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
         token_data = schemas.TokenData(username=username)
     except JWTError:
         raise credentials_exception
-    user = crud.get_user_by_email(db, email=token_data.username)
-    if user is None:
+    entry = crud.get_directory_entry_by_email(directory, email=token_data.username)
+    if entry is None:
         raise credentials_exception
+    if entry.moving:
+        # app.rebalance is copying this user to another shard; writes now would be lost
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Account is being moved, please retry shortly",
+            headers={"Retry-After": "5"},
+        )
+    return entry
+
+def get_db(entry: models.UserDirectory = Depends(get_current_directory_entry)):
+    # Session on the shard that owns the authenticated user. FastAPI caches
+    # dependencies per request, so routes and get_current_user share it.
+    yield from get_shard_db(entry.shard)
+
+async def get_current_user(entry: models.UserDirectory = Depends(get_current_directory_entry), db: Session = Depends(get_db)):
+    user = crud.get_user(db, entry.id)
+    if user is None:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     return user
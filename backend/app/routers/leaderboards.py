@@ -0,0 +1,22 @@
+from typing import Optional
+from fastapi import APIRouter, Depends, Query
+from .. import models
+from ..leaderboard import leaderboard
+from ..routers.auth import get_current_user
+
+router = APIRouter()
+
+@router.get("/leaderboard")
+def get_leaderboard(
+    window: str = Query("week", pattern="^(week|month|all)$"),
+    skill: Optional[str] = None,
+    limit: int = Query(10, ge=1, le=100),
+    current_user: models.User = Depends(get_current_user),
+):
+    # Served from the in-memory boards, no session scan per request
+    return {
+        "window": window,
+        "skill": skill,
+        "entries": leaderboard.top(window=window, skill_name=skill, limit=limit),
+        "me": leaderboard.rank(current_user.id, window=window, skill_name=skill),
+    }
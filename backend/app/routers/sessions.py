@@ -1,22 +1,50 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+import logging
+from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query, status
 from sqlalchemy.orm import Session
 from .. import crud, models, schemas
-from ..database import get_db
-from ..routers.auth import get_current_user
+from ..core.config import settings
+from ..heartbeats import heartbeat_buffer
+from ..leaderboard import leaderboard
+from ..search import search_reflections
+from ..routers.auth import get_current_directory_entry, get_current_user, get_db
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
 @router.post("/sessions", response_model=schemas.Session)
-def log_session(session: schemas.SessionCreate, skill_id: int, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+def log_session(session: schemas.SessionCreate, skill_id: int, client_session_id: Optional[str] = None, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user), entry: models.UserDirectory = Depends(get_current_directory_entry)):
     # Verify skill belongs to user
     skill = crud.get_skill(db, skill_id)
     if not skill or skill.user_id != current_user.id:
         raise HTTPException(status_code=404, detail="Skill not found")
         
-    db_session = crud.create_session(db=db, session=session, skill_id=skill_id)
-    crud.check_and_award_badges(db, current_user.id)
+    # Closing the heartbeat-tracked session in the same transaction keeps it
+    # from also being finalized automatically
+    if client_session_id:
+        heartbeat_buffer.discard(current_user.id, client_session_id)
+    # Badges are awarded by the "award_badges" background task
+    db_session = crud.create_session(db=db, session=session, skill_id=skill_id, user_id=current_user.id, client_session_id=client_session_id)
+    # A session already finalized from heartbeats comes back as is; the
+    # leaderboard skips session ids it has applied
+    try:
+        leaderboard.record_session(entry.shard, db_session, skill, current_user)
+    except Exception:
+        # The session is committed; replay on the next start picks it up
+        logger.exception("Leaderboard update failed for session %s", db_session.id)
     return db_session
 
+@router.post("/sessions/heartbeat", status_code=status.HTTP_202_ACCEPTED)
+def session_heartbeat(heartbeat: schemas.SessionHeartbeat, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user), entry: models.UserDirectory = Depends(get_current_directory_entry)):
+    skill = crud.get_skill(db, heartbeat.skill_id)
+    if not skill or skill.user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="Skill not found")
+
+    # Buffered in memory, persisted by the next periodic flush
+    heartbeat_buffer.record(current_user.id, heartbeat)
+    return {"status": "accepted", "flush_interval_seconds": settings.HEARTBEAT_FLUSH_INTERVAL_SECONDS}
+
 @router.post("/reflections", response_model=schemas.Reflection)
 def save_reflection(reflection: schemas.ReflectionCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     # Verify session belongs to user (via skill)
@@ -31,3 +59,16 @@ def save_reflection(reflection: schemas.ReflectionCreate, db: Session = Depends(
     
     # Adding simplified version for MVP speed
     return crud.create_reflection(db=db, reflection=reflection)
+
+@router.get("/reflections/search", response_model=List[schemas.ReflectionSearchResult])
+def search_user_reflections(
+    q: str = Query(..., min_length=1),
+    skill_id: Optional[int] = None,
+    difficulty: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=100),
+    offset: int = Query(0, ge=0),
+    db: Session = Depends(get_db),
+    current_user: models.User = Depends(get_current_user),
+):
+    # Ranked by bm25 over the reflections_fts index, best match first
+    return search_reflections(db, current_user.id, q, skill_id=skill_id, difficulty=difficulty, limit=limit, offset=offset)
@@ -1,33 +1,16 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, selectinload
 from .. import crud, models, schemas
-from ..database import get_db
-from ..routers.auth import get_current_user
-from ..core.plan_generator import generate_20_hour_plan
-from typing import List
+from ..routers.auth import get_current_user, get_db
+from typing import List, Optional
 
 router = APIRouter()
 
 @router.post("/skills", response_model=schemas.Skill)
 def create_skill(skill: schemas.SkillCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
     # Create skill (Allow multiple active skills - Dashboard will show latest)
-    db_skill = crud.create_skill(db=db, skill=skill, user_id=current_user.id)
-    
-    # Generate plan ONLY if status is active
-    if skill.status == "active":
-        plans = generate_20_hour_plan(skill.name, skill.daily_minutes)
-        
-        from datetime import date, timedelta
-        today = date.today()
-        
-        for plan in plans:
-            # Calculate scheduled date
-            # Day 1 = Today, Day 2 = Today + 1
-            scheduled = today + timedelta(days=plan['day_number'] - 1)
-            plan['scheduled_date'] = scheduled
-            crud.create_daily_plan(db, plan, db_skill.id)
-        
-    return db_skill
+    # The plan for active skills is generated by the "generate_plan" background task
+    return crud.create_skill(db=db, skill=skill, user_id=current_user.id)
 
 @router.get("/skills")
 def get_user_skills(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
@@ -73,15 +56,8 @@ def start_future_skill(skill_id: int, db: Session = Depends(get_db), current_use
     # Update status
     skill.status = "active"
     
-    # Generate plan NOW
-    plans = generate_20_hour_plan(skill.name, skill.daily_minutes)
-    from datetime import date, timedelta
-    today = date.today()
-    
-    for plan in plans:
-        scheduled = today + timedelta(days=plan['day_number'] - 1)
-        plan['scheduled_date'] = scheduled
-        crud.create_daily_plan(db, plan, skill.id)
+    # Generate plan in the background, committed together with the status change
+    crud.schedule_plan_generation(db, skill.id)
     
     db.commit()
     db.refresh(skill)
@@ -119,9 +95,8 @@ def shift_schedule(skill_id: int, days: int = 1, db: Session = Depends(get_db),
     return {"message": f"Schedule shifted by {days} days"}
 
 @router.post("/plans/{plan_id}/resources")
-def add_resource(plan_id: int, resource: dict, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
-    # Resource: {title, url, type}
-    plan = db.query(models.DailyPlan).join(models.Skill).filter(
+def add_resource(plan_id: int, resource: schemas.PlanResourceCreate, db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
+    plan = db.query(models.DailyPlan.id).join(models.Skill).filter(
         models.DailyPlan.id == plan_id,
         models.Skill.user_id == current_user.id
     ).first()
@@ -129,17 +104,9 @@ def add_resource(plan_id: int, resource: dict, db: Session = Depends(get_db), cu
     if not plan:
         raise HTTPException(status_code=404, detail="Plan not found")
         
-    current_resources = list(plan.resources) if plan.resources else []
-    current_resources.append(resource)
-    plan.resources = current_resources # Reassign to trigger update
-    
-    # SQLAlchemy requires explicit flag marked modified for JSON mutable if not using MutableDict?
-    # Or just reassignment works.
-    from sqlalchemy.orm.attributes import flag_modified
-    flag_modified(plan, "resources")
-    
+    crud.add_plan_resource(db, plan_id, resource)
     db.commit()
-    return plan.resources
+    return [r.as_dict() for r in crud.get_plan_resources(db, plan_id)]
 
 @router.get("/skills/active")
 def get_active_skill(db: Session = Depends(get_db), current_user: models.User = Depends(get_current_user)):
@@ -180,7 +147,9 @@ def get_dashboard_data(skill_id: Optional[int] = None, db: Session = Depends(get
     current_day_num = int(total_minutes // target_skill.daily_minutes) + 1
     
     # Fetch plan
-    current_plan = db.query(models.DailyPlan).filter(
+    current_plan = db.query(models.DailyPlan).options(
+        selectinload(models.DailyPlan.resource_links).joinedload(models.PlanResource.resource_url)
+    ).filter(
         models.DailyPlan.skill_id == target_skill.id,
         models.DailyPlan.day_number == current_day_num
     ).first()
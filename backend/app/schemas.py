@@ -1,5 +1,5 @@
 from typing import List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime, date
 
 # User Schemas
@@ -56,6 +56,11 @@ class DailyPlanBase(BaseModel):
 class DailyPlanCreate(DailyPlanBase):
     pass
 
+class PlanResourceCreate(BaseModel):
+    title: str
+    url: str
+    type: Optional[str] = "link"
+
 class DailyPlan(DailyPlanBase):
     id: int
     skill_id: int
@@ -85,11 +90,19 @@ class UserBadge(BaseModel):
         from_attributes = True
 
 # Session Schemas
+MAX_SESSION_MINUTES = 24 * 60
+
 class SessionBase(BaseModel):
     duration_minutes: int
 
 class SessionCreate(SessionBase):
-    pass
+    duration_minutes: int = Field(..., ge=1, le=MAX_SESSION_MINUTES)
+
+class SessionHeartbeat(BaseModel):
+    client_session_id: str = Field(..., min_length=8, max_length=64)
+    skill_id: int
+    elapsed_seconds: int = Field(..., ge=0, le=24 * 60 * 60)
+    started_at: Optional[datetime] = None
 
 class Session(SessionBase):
     id: int
@@ -114,3 +127,12 @@ class Reflection(ReflectionBase):
     
     class Config:
         from_attributes = True
+
+class ReflectionSearchResult(ReflectionBase):
+    id: int
+    session_id: int
+    skill_id: int
+    skill_name: str
+    date: datetime
+    snippet: str
+    rank: float
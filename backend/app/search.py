@@ -0,0 +1,89 @@
+"""Full-text search over reflections with SQLite FTS5.
+
+`reflections_fts` is an external-content FTS5 table: it stores only the index
+and reads the text back from `reflections`. Triggers keep it in sync on every
+insert, update and delete, so callers never touch it directly.
+"""
+import re
+from sqlalchemy import text
+
+REFLECTIONS_FTS_DDL = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS reflections_fts USING fts5(
+        content, key_takeaway,
+        content='reflections', content_rowid='id',
+        tokenize='porter unicode61'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS reflections_fts_ai AFTER INSERT ON reflections BEGIN
+        INSERT INTO reflections_fts(rowid, content, key_takeaway)
+        VALUES (new.id, new.content, new.key_takeaway);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS reflections_fts_ad AFTER DELETE ON reflections BEGIN
+        INSERT INTO reflections_fts(reflections_fts, rowid, content, key_takeaway)
+        VALUES ('delete', old.id, old.content, old.key_takeaway);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS reflections_fts_au AFTER UPDATE ON reflections BEGIN
+        INSERT INTO reflections_fts(reflections_fts, rowid, content, key_takeaway)
+        VALUES ('delete', old.id, old.content, old.key_takeaway);
+        INSERT INTO reflections_fts(rowid, content, key_takeaway)
+        VALUES (new.id, new.content, new.key_takeaway);
+    END
+    """,
+]
+
+# bm25 column weights: a match in the key takeaway counts double
+SEARCH_SQL = """
+    SELECT r.id, r.session_id, s.skill_id, sk.name AS skill_name, s.date,
+           r.difficulty, r.content, r.key_takeaway,
+           snippet(reflections_fts, -1, '**', '**', '...', 12) AS snippet,
+           bm25(reflections_fts, 1.0, 2.0) AS rank
+    FROM reflections_fts
+    JOIN reflections r ON r.id = reflections_fts.rowid
+    JOIN sessions s ON s.id = r.session_id
+    JOIN skills sk ON sk.id = s.skill_id
+    WHERE reflections_fts MATCH :query
+      AND sk.user_id = :user_id
+      {filters}
+    ORDER BY rank
+    LIMIT :limit OFFSET :offset
+"""
+
+def ensure_reflection_index(engine):
+    with engine.begin() as conn:
+        exists = conn.exec_driver_sql(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'reflections_fts'"
+        ).first()
+        for statement in REFLECTIONS_FTS_DDL:
+            conn.exec_driver_sql(statement)
+        if not exists:
+            # Index reflections written before the FTS table existed
+            conn.exec_driver_sql("INSERT INTO reflections_fts(reflections_fts) VALUES ('rebuild')")
+
+def build_match_query(query: str):
+    # Quote every word so user input can never be parsed as FTS5 syntax;
+    # the prefix star makes partial words ("trans") match while typing.
+    terms = re.findall(r"\w+", query)
+    return " ".join(f'"{term}"*' for term in terms)
+
+def search_reflections(db, user_id: int, query: str, skill_id: int = None, difficulty: str = None, limit: int = 20, offset: int = 0):
+    match = build_match_query(query)
+    if not match:
+        return []
+
+    filters = []
+    params = {"query": match, "user_id": user_id, "limit": limit, "offset": offset}
+    if skill_id is not None:
+        filters.append("AND s.skill_id = :skill_id")
+        params["skill_id"] = skill_id
+    if difficulty:
+        filters.append("AND r.difficulty = :difficulty")
+        params["difficulty"] = difficulty
+
+    rows = db.execute(text(SEARCH_SQL.format(filters=" ".join(filters))), params).mappings().all()
+    return [dict(row) for row in rows]
@@ -0,0 +1,177 @@
+"""Background tasks backed by a transactional outbox.
+
+Request handlers call `crud.enqueue_task` before committing, so an
+`outbox_tasks` row lands in the same shard transaction as the write that
+triggered it. `TaskRunner` (started in the app lifespan) polls every shard,
+claims due tasks and runs their handler in a worker thread.
+
+A handler receives a shard session plus the task payload and must not commit:
+its writes and the task's "done" status are committed together, so a task is
+never marked done without its effects, and a retried task never applies them
+twice. Failed tasks are retried with exponential backoff up to
+`max_attempts`. Tasks left "running" by a crashed process are picked up again
+on restart or once their lock times out.
+"""
+import asyncio
+import logging
+from datetime import date, datetime, timedelta
+from . import crud, models
+from .core.config import settings
+from .database import get_shard_session, shard_engines
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+def task(name: str):
+    def register(fn):
+        HANDLERS[name] = fn
+        return fn
+    return register
+
+@task("award_badges")
+def award_badges(db, user_id: int):
+    crud.check_and_award_badges(db, user_id)
+
+@task("generate_plan")
+def generate_plan(db, skill_id: int, start_date: str):
+    skill = crud.get_skill(db, skill_id)
+    if not skill:
+        return
+    # Idempotent: a plan that already exists is never generated twice
+    if db.query(models.DailyPlan.id).filter(models.DailyPlan.skill_id == skill_id).first():
+        return
+    crud.create_daily_plans(db, skill, date.fromisoformat(start_date))
+
+def claim_task(shard: int):
+    db = get_shard_session(shard)
+    try:
+        now = datetime.utcnow()
+        lock_expired = now - timedelta(seconds=settings.TASK_LOCK_TIMEOUT_SECONDS)
+        candidate = db.query(models.OutboxTask.id).filter(
+            ((models.OutboxTask.status == "pending") & (models.OutboxTask.run_after <= now))
+            | ((models.OutboxTask.status == "running") & (models.OutboxTask.locked_at < lock_expired))
+        ).order_by(models.OutboxTask.run_after, models.OutboxTask.id).first()
+        if not candidate:
+            return None
+
+        # Conditional update so two workers can never claim the same task
+        claimed = db.query(models.OutboxTask).filter(
+            models.OutboxTask.id == candidate.id,
+            ((models.OutboxTask.status == "pending")
+             | ((models.OutboxTask.status == "running") & (models.OutboxTask.locked_at < lock_expired)))
+        ).update({
+            models.OutboxTask.status: "running",
+            models.OutboxTask.locked_at: now,
+            models.OutboxTask.attempts: models.OutboxTask.attempts + 1,
+        }, synchronize_session=False)
+        db.commit()
+        return candidate.id if claimed else None
+    finally:
+        db.close()
+
+def run_task(shard: int, task_id: int):
+    db = get_shard_session(shard)
+    try:
+        outbox_task = db.get(models.OutboxTask, task_id)
+        try:
+            handler = HANDLERS.get(outbox_task.name)
+            if handler is None:
+                raise LookupError(f"No handler registered for task {outbox_task.name!r}")
+            handler(db, **(outbox_task.payload or {}))
+            outbox_task.status = "done"
+            outbox_task.finished_at = datetime.utcnow()
+            outbox_task.last_error = None
+            db.commit()
+        except Exception as exc:
+            db.rollback()
+            logger.exception("Task %s (%s) failed on shard %s", task_id, outbox_task.name, shard)
+            outbox_task = db.get(models.OutboxTask, task_id)
+            outbox_task.last_error = repr(exc)
+            if outbox_task.attempts >= outbox_task.max_attempts:
+                outbox_task.status = "failed"
+                outbox_task.finished_at = datetime.utcnow()
+            else:
+                outbox_task.status = "pending"
+                outbox_task.run_after = datetime.utcnow() + timedelta(seconds=2 ** outbox_task.attempts)
+            db.commit()
+    finally:
+        db.close()
+
+def recover_tasks():
+    # Called before the workers start: anything still "running" was orphaned
+    # by a previous process of this app.
+    recovered = 0
+    for shard in range(len(shard_engines)):
+        db = get_shard_session(shard)
+        try:
+            recovered += db.query(models.OutboxTask).filter(models.OutboxTask.status == "running").update(
+                {models.OutboxTask.status: "pending", models.OutboxTask.locked_at: None},
+                synchronize_session=False,
+            )
+            db.commit()
+        finally:
+            db.close()
+    return recovered
+
+def prune_tasks():
+    cutoff = datetime.utcnow() - timedelta(hours=settings.TASK_RETENTION_HOURS)
+    for shard in range(len(shard_engines)):
+        db = get_shard_session(shard)
+        try:
+            db.query(models.OutboxTask).filter(
+                models.OutboxTask.status == "done",
+                models.OutboxTask.finished_at < cutoff,
+            ).delete(synchronize_session=False)
+            db.commit()
+        finally:
+            db.close()
+
+class TaskRunner:
+    def __init__(self, workers: int = None, poll_interval: float = None):
+        self.workers = workers or settings.TASK_WORKERS
+        self.poll_interval = poll_interval or settings.TASK_POLL_INTERVAL_SECONDS
+        self._stopping = None
+        self._tasks = []
+        self._last_prune = None
+
+    async def start(self):
+        self._stopping = asyncio.Event()
+        recovered = await asyncio.to_thread(recover_tasks)
+        if recovered:
+            logger.info("Recovered %s interrupted background tasks", recovered)
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+
+    async def stop(self):
+        if self._stopping is None:
+            return
+        self._stopping.set()
+        # Workers finish the task they are running; unfinished ones stay in the outbox
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self, index: int):
+        shard_count = len(shard_engines)
+        loop = asyncio.get_running_loop()
+        while not self._stopping.is_set():
+            if index == 0 and (self._last_prune is None or loop.time() - self._last_prune >= 3600):
+                self._last_prune = loop.time()
+                await asyncio.to_thread(prune_tasks)
+            ran = False
+            # Workers start on different shards to spread SQLite writers
+            for offset in range(shard_count):
+                shard = (index + offset) % shard_count
+                try:
+                    task_id = await asyncio.to_thread(claim_task, shard)
+                    if task_id is not None:
+                        await asyncio.to_thread(run_task, shard, task_id)
+                        ran = True
+                except Exception:
+                    logger.exception("Background worker %s failed on shard %s", index, shard)
+            if not ran:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+task_runner = TaskRunner()
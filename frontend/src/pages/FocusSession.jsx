@@ -1,10 +1,12 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import { useNavigate } from 'react-router-dom';
 import useStore from '../store/store';
 import api from '../lib/axios';
 import { motion, AnimatePresence } from 'framer-motion';
 import { Play, Pause, Square, Save, ArrowLeft } from 'lucide-react';
 
+const HEARTBEAT_INTERVAL_MS = 15000;
+
 const FocusSession = () => {
     const { activeSkill, fetchActiveSkill } = useStore();
     const navigate = useNavigate();
@@ -14,6 +16,11 @@ const FocusSession = () => {
     const [sessionState, setSessionState] = useState('idle'); // idle, running, paused, reflecting, saving
     const [targetDuration, setTargetDuration] = useState(20);
 
+    // Heartbeat state: lets the backend keep progress if this tab dies
+    const clientSessionIdRef = useRef(null);
+    const startedAtRef = useRef(null);
+    const elapsedRef = useRef(0);
+
     // Reflection state
     const [reflection, setReflection] = useState({
         content: '',
@@ -33,6 +40,28 @@ const FocusSession = () => {
         return () => clearInterval(interval);
     }, [isRunning]);
 
+    useEffect(() => {
+        elapsedRef.current = elapsedSeconds;
+    }, [elapsedSeconds]);
+
+    useEffect(() => {
+        // Keep beating while running, paused and reflecting, until the session is saved
+        if (!['running', 'reflecting'].includes(sessionState) || !activeSkill || !clientSessionIdRef.current) {
+            return;
+        }
+        const sendHeartbeat = () => {
+            api.post('/sessions/heartbeat', {
+                client_session_id: clientSessionIdRef.current,
+                skill_id: activeSkill.id,
+                elapsed_seconds: elapsedRef.current,
+                started_at: startedAtRef.current
+            }).catch(error => console.error(error));
+        };
+        sendHeartbeat();
+        const interval = setInterval(sendHeartbeat, HEARTBEAT_INTERVAL_MS);
+        return () => clearInterval(interval);
+    }, [sessionState, activeSkill]);
+
     useEffect(() => {
         // Ensure we have active skill data
         if (!activeSkill) {
@@ -44,6 +73,13 @@ const FocusSession = () => {
 
     const toggleTimer = () => setIsRunning(!isRunning);
 
+    const startSession = () => {
+        clientSessionIdRef.current = crypto.randomUUID();
+        startedAtRef.current = new Date().toISOString();
+        setIsRunning(true);
+        setSessionState('running');
+    };
+
     const stopTimer = () => {
         setIsRunning(false);
         setSessionState('reflecting');
@@ -62,7 +98,7 @@ const FocusSession = () => {
             const sessionRes = await api.post('/sessions', {
                 duration_minutes: durationMinutes > 0 ? durationMinutes : 1
             }, {
-                params: { skill_id: activeSkill.id }
+                params: { skill_id: activeSkill.id, client_session_id: clientSessionIdRef.current }
             });
 
             const sessionId = sessionRes.data.id;
@@ -219,7 +255,7 @@ const FocusSession = () => {
             <div className="flex items-center gap-6">
                 {sessionState === 'idle' && elapsedSeconds === 0 ? (
                     <button
-                        onClick={() => { setIsRunning(true); setSessionState('running'); }}
+                        onClick={startSession}
                         className="w-16 h-16 bg-black text-white rounded-full flex items-center justify-center hover:scale-105 transition-transform"
                     >
                         <Play size={24} fill="currentColor" className="ml-1" />